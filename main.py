@@ -1,9 +1,22 @@
+import asyncio
+import atexit
+import contextlib
 import discord
-import openai
+import functools
 import os
-import json
+import pathlib
 import random
+import re
+import sqlite3
+import sys
+import time
+import traceback
+import numpy as np
+import orjson
+from collections import deque
+from discord.ext import commands
 from dotenv import load_dotenv
+from openai import AsyncOpenAI
 
 """
 This Discord bot acts as a Dungeons & Dragons (D&D) assistant using OpenAI's
@@ -22,10 +35,15 @@ Commands:
   !endturn            – End the current character's turn, advancing to next.
   !endcombat          – End the encounter and clear combat state.
 
-Persistent state for characters and combats is stored in JSON files
-(`character_data.json` and `combat_data.json` respectively) in the working
-directory. If those files exist at startup, they will be loaded so that
-character sheets and ongoing combats persist across restarts.
+Persistent state for characters and combats is stored in a SQLite database
+(`dnd.db`, WAL mode) in the working directory, so character sheets and ongoing
+combats persist across restarts and each change writes only the rows it
+touches. Data from older JSON files (`state.json`, or `character_data.json`
+and `combat_data.json`) is imported the first time the database is created.
+
+Replies to `!dnd` are kept in a small semantic cache (`prompt_cache.json`):
+a prompt that is close enough in meaning to one already answered reuses the
+stored reply rather than calling GPT‑4 again.
 """
 
 load_dotenv()  # Load environment variables from a .env file (if present)
@@ -35,55 +53,367 @@ load_dotenv()  # Load environment variables from a .env file (if present)
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-openai.api_key = OPENAI_API_KEY
-
-# Paths to our JSON persistence files.
-CHARACTER_FILE = "character_data.json"
-COMBAT_FILE = "combat_data.json"
-
-# In‑memory stores for characters and combat encounters.  These will be
-# loaded from disk at startup and written back on changes.
+# Async client so a slow completion doesn't block the Discord event loop.
+# Created in the entrypoint once the key has been checked: the SDK raises on
+# a missing key, which would otherwise break importing this module.
+aclient: AsyncOpenAI | None = None
+
+# Characters and combat state live in a SQLite database.  The JSON files are
+# only read once, to migrate data from older versions into an empty database.
+DB_FILE = "dnd.db"
+STATE_FILE = "state.json"
+LEGACY_CHARACTER_FILE = "character_data.json"
+LEGACY_COMBAT_FILE = "combat_data.json"
+PROMPT_CACHE_FILE = "prompt_cache.json"
+
+# In‑memory copies of the characters and combat encounter.  Reads are served
+# from these; every change is also written through to the database.
 characters = {}
 combat_state = {}
+# User ids of all characters in creation order, kept in step with
+# `characters` so starting combat doesn't have to rebuild it.
+character_order: list[str] = []
+
+# Semantic cache for !dnd replies.  Prompts are embedded and compared against
+# previously answered prompts; a close enough match reuses the stored reply
+# instead of paying for another GPT-4 completion.
+EMBEDDING_MODEL = "text-embedding-3-small"
+PROMPT_CACHE_THRESHOLD = 0.9  # Minimum cosine similarity for a hit
+PROMPT_CACHE_MAX_ENTRIES = 2048
+PROMPT_CACHE_SAVE_EVERY = 32  # Persist after this many new entries
+
+prompt_cache: list[tuple[np.ndarray, str]] = []
+prompt_cache_hits: list[int] = []  # Hit counts, parallel to prompt_cache
+# Insertion sequence numbers, parallel to prompt_cache.  Eviction takes the
+# oldest of the least‑used entries, so ties don't keep recycling one slot.
+prompt_cache_seq: list[int] = []
+_prompt_cache_next_seq = 0
+# Embeddings stacked into a fixed (PROMPT_CACHE_MAX_ENTRIES, dim) matrix; row i
+# mirrors prompt_cache[i] and is overwritten in place on insert or eviction.
+_prompt_matrix: np.ndarray | None = None
+_prompt_cache_unsaved = 0
+
+
+def _read_json(path: str):
+    """Parse a JSON file with orjson, returning None if it is missing or invalid."""
+    if not os.path.isfile(path):
+        return None
+    try:
+        return orjson.loads(pathlib.Path(path).read_bytes())
+    except Exception as e:
+        print(f"Error loading {path}: {e}")
+        return None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS characters (
+    user_id TEXT PRIMARY KEY,
+    name    TEXT NOT NULL,
+    class   TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS items (
+    user_id TEXT NOT NULL,
+    item    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_user_id ON items (user_id);
+CREATE TABLE IF NOT EXISTS combat_kv (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
 
+db: sqlite3.Connection | None = None
 
-def load_data() -> None:
-    """Load character and combat data from JSON files if they exist."""
-    global characters, combat_state
-    # Load characters
-    if os.path.isfile(CHARACTER_FILE):
-        try:
-            with open(CHARACTER_FILE, "r", encoding="utf-8") as f:
-                characters = json.load(f)
-        except Exception as e:
-            print(f"Error loading {CHARACTER_FILE}: {e}")
-            characters = {}
-    # Load combat state
-    if os.path.isfile(COMBAT_FILE):
-        try:
-            with open(COMBAT_FILE, "r", encoding="utf-8") as f:
-                combat_state = json.load(f)
-        except Exception as e:
-            print(f"Error loading {COMBAT_FILE}: {e}")
-            combat_state = {}
-
-
-def save_characters() -> None:
-    """Persist the character dictionary to disk."""
+
+def open_db() -> None:
+    """Open the database in WAL mode and create the schema if needed.
+
+    With WAL and synchronous=NORMAL a mutation appends to the log instead of
+    rewriting the whole store, and commits don't wait on an fsync.
+    """
+    global db
+    db = sqlite3.connect(DB_FILE, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+
+
+def close_db() -> None:
+    """Close the database, checkpointing the WAL back into the main file."""
+    if db is not None:
+        db.close()
+
+
+atexit.register(close_db)
+
+
+@contextlib.contextmanager
+def transaction():
+    """Group several statements into one atomic commit."""
+    db.execute("BEGIN")
     try:
-        with open(CHARACTER_FILE, "w", encoding="utf-8") as f:
-            json.dump(characters, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving characters: {e}")
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def _migrate_json_state() -> None:
+    """Import characters and combat state from the pre‑SQLite JSON files."""
+    state = _read_json(STATE_FILE)
+    if state is None:
+        state = {
+            "characters": _read_json(LEGACY_CHARACTER_FILE) or {},
+            "combat": _read_json(LEGACY_COMBAT_FILE) or {},
+        }
+    chars = state.get("characters", {})
+    # Preserve the saved creation order, then any characters it missed.
+    order = dict.fromkeys([*state.get("character_order", []), *chars])
+    with transaction():
+        for user_id in order:
+            char = chars.get(user_id)
+            if char is None:
+                continue
+            db.execute(
+                "INSERT INTO characters (user_id, name, class) VALUES (?, ?, ?)",
+                (user_id, char.get("name", ""), char.get("class", "")),
+            )
+            db.executemany(
+                "INSERT INTO items (user_id, item) VALUES (?, ?)",
+                ((user_id, item) for item in char.get("items", [])),
+            )
+        db.executemany(
+            "INSERT INTO combat_kv (key, value) VALUES (?, ?)",
+            ((k, orjson.dumps(v).decode()) for k, v in state.get("combat", {}).items()),
+        )
+
+
+def load_data() -> None:
+    """Load characters and combat state from the database.
+
+    An empty database is first populated from the older JSON files, if any,
+    so existing deployments keep their data.
+    """
+    global characters, combat_state, character_order
+    if db.execute("SELECT 1 FROM characters UNION ALL SELECT 1 FROM combat_kv LIMIT 1").fetchone() is None:
+        _migrate_json_state()
+    # rowid order is creation order: re‑creating a character updates its row
+    # in place rather than inserting a new one.
+    # Class names and items repeat across characters ("Fighter", "Torch"), so
+    # they are interned to share one string object each.
+    characters = {
+        user_id: {"name": name, "class": sys.intern(char_class), "items": []}
+        for user_id, name, char_class in db.execute(
+            "SELECT user_id, name, class FROM characters ORDER BY rowid"
+        )
+    }
+    for user_id, item in db.execute("SELECT user_id, item FROM items ORDER BY rowid"):
+        characters[user_id]["items"].append(sys.intern(item))
+    character_order = list(characters)
+    combat_state = {
+        key: orjson.loads(value)
+        for key, value in db.execute("SELECT key, value FROM combat_kv")
+    }
+    # The head of the turn order deque is whoever's turn it is.  Older saves
+    # tracked that with a separate index instead; fold it into the rotation.
+    if "turn_order" in combat_state:
+        turn_order = deque(combat_state["turn_order"])
+        combat_state["turn_order"] = turn_order
+        if "current_index" in combat_state:
+            turn_order.rotate(-combat_state.pop("current_index"))
+            save_combat()
+
+
+def _encode_combat_value(value) -> str:
+    # default=list lets the turn order deque be stored as a plain JSON array.
+    return orjson.dumps(value, default=list).decode()
 
 
 def save_combat() -> None:
-    """Persist the combat state to disk."""
+    """Replace the stored combat state with the in‑memory one."""
+    with transaction():
+        db.execute("DELETE FROM combat_kv")
+        db.executemany(
+            "INSERT INTO combat_kv (key, value) VALUES (?, ?)",
+            ((k, _encode_combat_value(v)) for k, v in combat_state.items()),
+        )
+
+
+def save_combat_key(key: str) -> None:
+    """Write a single combat state entry."""
+    db.execute(
+        "INSERT OR REPLACE INTO combat_kv (key, value) VALUES (?, ?)",
+        (key, _encode_combat_value(combat_state[key])),
+    )
+
+
+def _atomic_write_bytes(path: str, data: bytes) -> None:
+    """Durably replace path with data so a crash never leaves a partial file.
+
+    The bytes go to a temporary file in one write, are fsynced, and then
+    renamed over the target.
+    """
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+
+def _store_prompt_row(row: int, embedding: np.ndarray) -> None:
+    """Write an embedding into the lookup matrix, allocating it on first use."""
+    global _prompt_matrix
+    if _prompt_matrix is None:
+        _prompt_matrix = np.zeros(
+            (PROMPT_CACHE_MAX_ENTRIES, embedding.shape[0]), dtype=np.float32
+        )
+    _prompt_matrix[row] = embedding
+
+
+def load_prompt_cache() -> None:
+    """Load the !dnd semantic cache from disk if it exists."""
+    global _prompt_matrix, _prompt_cache_next_seq
+    entries = _read_json(PROMPT_CACHE_FILE)
+    if entries is None:
+        return
+    prompt_cache.clear()
+    prompt_cache_hits.clear()
+    prompt_cache_seq.clear()
+    _prompt_matrix = None
+    # Empty replies can't be sent to Discord; skip any saved by older versions.
+    entries = [entry for entry in entries if entry.get("reply")]
+    for entry in entries[:PROMPT_CACHE_MAX_ENTRIES]:
+        embedding = np.asarray(entry["embedding"], dtype=np.float32)
+        _store_prompt_row(len(prompt_cache), embedding)
+        prompt_cache.append((embedding, entry["reply"]))
+        prompt_cache_hits.append(entry.get("hits", 0))
+        # Files saved before sequence numbers existed fall back to file order.
+        prompt_cache_seq.append(entry.get("seq", len(prompt_cache_seq)))
+    _prompt_cache_next_seq = max(prompt_cache_seq, default=-1) + 1
+
+
+def _write_prompt_cache(entries: list[dict]) -> None:
     try:
-        with open(COMBAT_FILE, "w", encoding="utf-8") as f:
-            json.dump(combat_state, f, ensure_ascii=False, indent=2)
+        data = orjson.dumps(entries, option=orjson.OPT_SERIALIZE_NUMPY)
+        _atomic_write_bytes(PROMPT_CACHE_FILE, data)
     except Exception as e:
-        print(f"Error saving combat state: {e}")
+        print(f"Error saving prompt cache: {e}")
+
+
+def _prompt_cache_snapshot() -> list[dict]:
+    # The embedding arrays themselves are never mutated, so orjson can encode
+    # them later without copying.
+    return [
+        {"embedding": emb, "reply": reply, "hits": hits, "seq": seq}
+        for (emb, reply), hits, seq in zip(prompt_cache, prompt_cache_hits, prompt_cache_seq)
+    ]
+
+
+async def save_prompt_cache() -> None:
+    """Persist the !dnd semantic cache without blocking the event loop."""
+    global _prompt_cache_unsaved
+    _prompt_cache_unsaved = 0
+    # Snapshot on the loop so the worker thread never sees a cache mid-update.
+    await asyncio.to_thread(_write_prompt_cache, _prompt_cache_snapshot())
+
+
+def flush_prompt_cache() -> None:
+    """Synchronously save any unsaved cache entries; used at shutdown."""
+    global _prompt_cache_unsaved
+    if _prompt_cache_unsaved:
+        _prompt_cache_unsaved = 0
+        _write_prompt_cache(_prompt_cache_snapshot())
+
+
+atexit.register(flush_prompt_cache)
+
+
+async def embed_prompt(prompt: str) -> np.ndarray:
+    """Return the unit‑length embedding vector for a !dnd prompt."""
+    response = await aclient.embeddings.create(model=EMBEDDING_MODEL, input=prompt)
+    vec = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def lookup_prompt_cache(embedding: np.ndarray) -> tuple[int, str] | None:
+    """Return (row, reply) for the nearest cached prompt, or None on a miss.
+
+    The hit is not counted here; call record_prompt_cache_hit once the reply
+    has actually been sent.
+    """
+    if not prompt_cache:
+        return None
+    # Embeddings are normalised, so one matrix‑vector product gives every
+    # cosine similarity at once.
+    scores = _prompt_matrix[:len(prompt_cache)] @ embedding
+    best = int(np.argmax(scores))
+    if scores[best] < PROMPT_CACHE_THRESHOLD:
+        return None
+    return best, prompt_cache[best][1]
+
+
+def record_prompt_cache_hit(row: int, reply: str) -> None:
+    """Count a served hit, unless the row was replaced while it was sent."""
+    if row < len(prompt_cache) and prompt_cache[row][1] is reply:
+        prompt_cache_hits[row] += 1
+
+
+async def add_to_prompt_cache(embedding: np.ndarray, reply: str) -> None:
+    """Store a fresh reply, evicting the least frequently used entry if full."""
+    global _prompt_cache_unsaved, _prompt_cache_next_seq
+    if not split_message(reply):
+        # Nothing Discord would accept; caching it would only fail every hit.
+        return
+    if len(prompt_cache) >= PROMPT_CACHE_MAX_ENTRIES:
+        # Reuse the evicted entry's slot so no other rows have to move.
+        row = min(
+            range(len(prompt_cache)),
+            key=lambda i: (prompt_cache_hits[i], prompt_cache_seq[i]),
+        )
+        prompt_cache[row] = (embedding, reply)
+        prompt_cache_hits[row] = 0
+        prompt_cache_seq[row] = _prompt_cache_next_seq
+    else:
+        row = len(prompt_cache)
+        prompt_cache.append((embedding, reply))
+        prompt_cache_hits.append(0)
+        prompt_cache_seq.append(_prompt_cache_next_seq)
+    _prompt_cache_next_seq += 1
+    _store_prompt_row(row, embedding)
+    _prompt_cache_unsaved += 1
+    if _prompt_cache_unsaved >= PROMPT_CACHE_SAVE_EVERY:
+        await save_prompt_cache()
+
+
+MAX_DICE = 1_000
+MAX_SIDES = 1_000_000
+VECTOR_ROLL_THRESHOLD = 64  # Above this many dice, roll with numpy
+DICE_RE = re.compile(r"^(\d+)d(\d+)$", re.IGNORECASE)
+_rng = np.random.default_rng()
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_dice(expr: str) -> tuple[int, int]:
+    """Parse an expression like '2d20' into (dice, sides).
+
+    Players reuse a handful of expressions, so results are memoised.  Raises
+    ValueError on bad formatting or out‑of‑range values.
+    """
+    match = DICE_RE.match(expr.strip())
+    if not match:
+        raise ValueError("Dice expression must be in NdM format.")
+    n, m = int(match[1]), int(match[2])
+    if n <= 0 or m <= 0:
+        raise ValueError("Number of dice and sides must be positive.")
+    if n > MAX_DICE or m > MAX_SIDES:
+        raise ValueError(f"You can roll at most {MAX_DICE} dice with up to {MAX_SIDES} sides.")
+    return n, m
 
 
 def parse_dice_expression(expr: str) -> list[int]:
@@ -92,22 +422,55 @@ def parse_dice_expression(expr: str) -> list[int]:
     Returns a list of individual dice results.  Raises ValueError on bad
     formatting.
     """
-    try:
-        parts = expr.lower().split("d")
-        if len(parts) != 2:
-            raise ValueError("Dice expression must be in NdM format.")
-        n, m = int(parts[0]), int(parts[1])
-        if n <= 0 or m <= 0:
-            raise ValueError("Number of dice and sides must be positive.")
-        return [random.randint(1, m) for _ in range(n)]
-    except Exception as e:
-        raise ValueError(str(e)) from e
+    n, m = _parse_dice(expr)
+    # Both paths run the RNG loop in C rather than calling randint per die.
+    if n > VECTOR_ROLL_THRESHOLD:
+        return _rng.integers(1, m + 1, size=n).tolist()
+    return random.choices(range(1, m + 1), k=n)
+
+
+def _make_fast_roll(n: int, m: int):
+    """Build a roller specialised for exactly n dice with m sides."""
+    randint = random.randint
+    if n == 1:
+        return lambda: [randint(1, m)]
+    if n == 2:
+        return lambda: [randint(1, m), randint(1, m)]
+    faces = range(1, m + 1)
+    return lambda: random.choices(faces, k=n)
+
+
+# Pre‑built rollers for the expressions players use most.  A hit skips the
+# regex, the parse cache and the generic roll path entirely.
+FAST_ROLLS = {
+    f"{n}d{m}": _make_fast_roll(n, m)
+    for n, m in [
+        (1, 4), (1, 6), (1, 8), (1, 10), (1, 12), (1, 20), (1, 100),
+        (2, 4), (2, 6), (2, 8), (2, 10), (2, 12), (2, 20),
+        (3, 6), (4, 4), (4, 6), (6, 6), (8, 6), (3, 8), (4, 8),
+    ]
+}
 
 
 intents = discord.Intents.default()
 intents.message_content = True  # Required to read message content
 
-client = discord.Client(intents=intents)
+# The commands framework maps "!name" to its handler with a dict lookup and
+# splits off the argument text for us.  The built‑in help command is disabled
+# to keep the command set unchanged.  AutoShardedBot asks Discord for the
+# recommended shard count, so the bot keeps working past the point where a
+# single gateway connection is no longer allowed.
+class DnDBot(commands.AutoShardedBot):
+    async def process_commands(self, message: discord.Message) -> None:
+        # The stock implementation drops messages from every bot account;
+        # like the original on_message handler, only ignore our own.
+        if message.author == self.user:
+            return
+        ctx = await self.get_context(message)
+        await self.invoke(ctx)
+
+
+bot = DnDBot(command_prefix="!", intents=intents, help_command=None)
 
 # System message sets the tone for ChatGPT Dungeon Master responses.
 SYSTEM_PROMPT = {
@@ -120,161 +483,408 @@ SYSTEM_PROMPT = {
 }
 
 
-@client.event
+@bot.event
 async def on_ready() -> None:
-    print(f"Logged in as {client.user}")
-    load_data()  # Load persisted state at startup
+    print(f"Logged in as {bot.user}")
 
 
-@client.event
-async def on_message(message: discord.Message) -> None:
-    # Ignore messages from ourselves
-    if message.author == client.user:
-        return
+# Discord rejects messages longer than this many characters.
+DISCORD_MESSAGE_LIMIT = 2000
 
-    content = message.content.strip()
-    # D&D chat with ChatGPT
-    if content.startswith("!dnd"):
-        prompt = content[4:].strip()
-        if not prompt:
-            await message.channel.send("Please provide an action or query after !dnd.")
-            return
-        messages = [SYSTEM_PROMPT, {"role": "user", "content": prompt}]
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=messages,
-                max_tokens=500,
-                temperature=0.9,
-            )
-            reply = response.choices[0].message.content.strip()
-            await message.channel.send(reply)
-        except Exception as e:
-            await message.channel.send(f"⚠️ Error contacting OpenAI: {e}")
-        return
 
-    # Dice roller: !roll NdM
-    if content.startswith("!roll"):
-        expr = content[5:].strip()
-        try:
-            rolls = parse_dice_expression(expr)
-            total = sum(rolls)
-            roll_details = "+".join(str(r) for r in rolls)
-            await message.channel.send(f"🎲 You rolled: {roll_details} = {total}")
-        except ValueError as e:
-            await message.channel.send(f"⚠️ {e}")
-        return
+def _wrap_line(line: str) -> list[str]:
+    """Split a line into pieces that each fit in one message.
 
-    # Character creation: !createchar Name
-    if content.startswith("!createchar"):
-        name = content[len("!createchar"):].strip()
-        if not name:
-            await message.channel.send("Please provide a name for your character.")
-            return
-        user_id = str(message.author.id)
-        characters[user_id] = {
-            "name": name,
-            "class": "",
-            "items": [],
-        }
-        save_characters()
-        await message.channel.send(f"Character '{name}' created!")
+    Breaks at the last space before the limit where there is one, and
+    hard‑cuts otherwise.
+    """
+    pieces = []
+    while len(line) > DISCORD_MESSAGE_LIMIT:
+        cut = line.rfind(" ", 0, DISCORD_MESSAGE_LIMIT + 1)
+        if cut <= 0:
+            cut = DISCORD_MESSAGE_LIMIT
+        pieces.append(line[:cut])
+        line = line[cut:].lstrip(" ")
+    pieces.append(line)
+    return pieces
+
+
+def split_message(text: str) -> list[str]:
+    """Split text into as few Discord‑sized messages as possible.
+
+    Messages break between lines where they can and otherwise at word
+    boundaries (see _wrap_line).  Blank pieces are dropped, since Discord
+    rejects empty messages.
+    """
+    messages = []
+    chunk = None
+    for line in text.split("\n"):
+        for piece in _wrap_line(line):
+            if chunk is None:
+                chunk = piece
+            elif len(chunk) + 1 + len(piece) > DISCORD_MESSAGE_LIMIT:
+                messages.append(chunk)
+                chunk = piece
+            else:
+                chunk = f"{chunk}\n{piece}"
+    if chunk is not None:
+        messages.append(chunk)
+    return [message for message in messages if message.strip()]
+
+
+class ReplyBuffer:
+    """Collect a command's reply lines and send them as one message.
+
+    Each channel.send is a separate HTTPS request that counts against
+    Discord's rate limits, so multi‑line replies are buffered and sent on
+    exit, split only where the message length limit requires it (lines
+    longer than the limit are wrapped).
+    """
+
+    def __init__(self, channel: discord.abc.Messageable) -> None:
+        self.channel = channel
+        self.lines: list[str] = []
+
+    def add(self, line: str) -> None:
+        self.lines.append(line)
+
+    async def flush(self) -> None:
+        for message in split_message("\n".join(self.lines)):
+            await self.channel.send(message)
+        self.lines.clear()
+
+    async def __aenter__(self) -> "ReplyBuffer":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self.flush()
+
+
+# Outbound OpenAI calls are capped at DND_MAX_CONCURRENCY at a time; extra
+# !dnd requests wait their turn instead of piling up and triggering 429s.
+DND_MAX_CONCURRENCY = 8
+DND_SEMAPHORE = asyncio.Semaphore(DND_MAX_CONCURRENCY)
+
+# Per‑user token bucket so one player can't monopolise those slots.  Each
+# user may burst DND_BUCKET_CAPACITY requests, refilling one every
+# DND_REFILL_SECONDS.
+DND_BUCKET_CAPACITY = 3
+DND_REFILL_SECONDS = 20.0
+dnd_buckets: dict[str, tuple[float, float]] = {}  # user_id -> (tokens, last refill)
+# A bucket untouched this long has refilled completely, which is the same as
+# having no entry, so it can be dropped.
+DND_BUCKET_IDLE_SECONDS = DND_BUCKET_CAPACITY * DND_REFILL_SECONDS
+_last_bucket_sweep = 0.0
+
+
+def _sweep_dnd_buckets(now: float) -> None:
+    """Forget full buckets so dnd_buckets doesn't grow with every user seen."""
+    global _last_bucket_sweep
+    if now - _last_bucket_sweep < DND_BUCKET_IDLE_SECONDS:
         return
+    _last_bucket_sweep = now
+    for user_id, (_, last) in list(dnd_buckets.items()):
+        if now - last >= DND_BUCKET_IDLE_SECONDS:
+            del dnd_buckets[user_id]
 
-    # Character sheet: !sheet
-    if content.startswith("!sheet"):
-        user_id = str(message.author.id)
-        char = characters.get(user_id)
-        if not char:
-            await message.channel.send("You don't have a character yet. Use !createchar <name> to create one.")
-            return
-        name = char.get("name", "Unnamed")
-        char_class = char.get("class", "Unassigned") or "Unassigned"
-        items = char.get("items", [])
-        item_list = ", ".join(items) if items else "No items"
-        await message.channel.send(
-            f"📜 **{name}** (Class: {char_class})\nInventory: {item_list}"
-        )
+
+def take_dnd_token(user_id: str) -> bool:
+    """Consume one !dnd token for the user; False if their bucket is empty."""
+    now = time.monotonic()
+    _sweep_dnd_buckets(now)
+    tokens, last = dnd_buckets.get(user_id, (DND_BUCKET_CAPACITY, now))
+    tokens = min(DND_BUCKET_CAPACITY, tokens + (now - last) / DND_REFILL_SECONDS)
+    if tokens < 1:
+        dnd_buckets[user_id] = (tokens, now)
+        return False
+    dnd_buckets[user_id] = (tokens - 1, now)
+    return True
+
+
+# Discord allows 5 edits per 5 seconds on a message; stay just under that.
+STREAM_EDIT_INTERVAL = 1.1
+
+
+async def stream_reply(ctx: commands.Context, stream) -> str:
+    """Show a streamed completion as it arrives and return the full text.
+
+    The first tokens are sent as a new message straight away, which is then
+    edited at most once per STREAM_EDIT_INTERVAL as more text comes in.
+    """
+    parts: list[str] = []
+    sent: discord.Message | None = None
+    shown = ""
+    last_edit = 0.0
+    async for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        parts.append(chunk.choices[0].delta.content)
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+        # Only the first message's worth is shown while streaming, split the
+        # same way as the final reply so the text doesn't reflow at the end.
+        pending = split_message("".join(parts).strip())
+        if not pending:
+            continue
+        text = pending[0]
+        if sent is None:
+            sent = await ctx.send(text)
+        else:
+            await sent.edit(content=text)
+        shown = text
+        last_edit = now
+    reply = "".join(parts).strip()
+    messages = split_message(reply)
+    if not messages:
+        return reply
+    head, rest = messages[0], messages[1:]
+    if sent is None:
+        await ctx.send(head)
+    elif head != shown:
+        await sent.edit(content=head)
+    # Anything past Discord's length limit follows as extra messages.
+    for message in rest:
+        await ctx.send(message)
+    return reply
+
+
+# Limits on character input, checked before anything is stored so a single
+# command can't bloat every character sheet and the database.  A full
+# inventory (MAX_ITEMS × MAX_ITEM_LENGTH) is longer than one Discord message;
+# !sheet then lists it one item per line across several messages.
+MAX_NAME_LENGTH = 64
+MAX_CLASS_LENGTH = 64
+MAX_ITEM_LENGTH = 128
+MAX_ITEMS = 256
+
+
+def character_name(user_id: str) -> str:
+    """Display name for a combatant.
+
+    Turn orders saved before they held user ids contain names directly, so an
+    unknown id is shown as‑is.
+    """
+    char = characters.get(user_id)
+    return char["name"] if char else user_id
+
+
+@bot.command(name="dnd")
+async def handle_dnd(ctx: commands.Context, *, prompt: str = "") -> None:
+    """D&D chat with ChatGPT: !dnd <text>"""
+    if not prompt:
+        await ctx.send("Please provide an action or query after !dnd.")
         return
+    user_id = str(ctx.author.id)
+    if not take_dnd_token(user_id):
+        await ctx.send("⏳ You're sending !dnd requests too quickly; please wait a moment.")
+        return
+    # The cache is only an optimisation: if embedding fails, skip it and go
+    # straight to the completion.
+    embedding = None
+    try:
+        async with DND_SEMAPHORE:
+            embedding = await embed_prompt(prompt)
+    except Exception as e:
+        print(f"Error embedding !dnd prompt: {e}")
+    try:
+        hit = lookup_prompt_cache(embedding) if embedding is not None else None
+        if hit is None:
+            async with DND_SEMAPHORE:
+                stream = await aclient.chat.completions.create(
+                    model="gpt-4",
+                    # Single‑turn: just the shared system prompt and this
+                    # prompt, built only on a cache miss.
+                    messages=[SYSTEM_PROMPT, {"role": "user", "content": prompt}],
+                    max_tokens=500,
+                    temperature=0.9,
+                    stream=True,
+                )
+                reply = await stream_reply(ctx, stream)
+            if not reply:
+                # Nothing was shown, and an empty entry would make every
+                # similar prompt fail to send, so keep it out of the cache.
+                await ctx.send("🤔 The Dungeon Master has no answer for that; try rephrasing.")
+                return
+            if embedding is not None:
+                await add_to_prompt_cache(embedding, reply)
+        else:
+            # Split like a streamed reply: cached replies can be just as long.
+            row, reply = hit
+            for chunk in split_message(reply):
+                await ctx.send(chunk)
+            record_prompt_cache_hit(row, reply)
+    except Exception as e:
+        await ctx.send(f"⚠️ Error contacting OpenAI: {e}")
 
-    # Set class: !setclass Class Name
-    if content.startswith("!setclass"):
-        class_name = content[len("!setclass"):].strip()
-        user_id = str(message.author.id)
-        char = characters.get(user_id)
-        if not char:
-            await message.channel.send("Create a character first using !createchar.")
-            return
-        if not class_name:
-            await message.channel.send("Please specify a class.")
-            return
-        char["class"] = class_name
-        save_characters()
-        await message.channel.send(f"Class set to {class_name} for {char['name']}.")
+
+@bot.command(name="roll")
+async def handle_roll(ctx: commands.Context, *, expr: str = "") -> None:
+    """Dice roller: !roll NdM"""
+    try:
+        fast_roll = FAST_ROLLS.get(expr)
+        rolls = fast_roll() if fast_roll else parse_dice_expression(expr)
+        total = sum(rolls)
+        roll_details = "+".join(map(str, rolls))
+        result = f"🎲 You rolled: {roll_details} = {total}"
+        if len(result) > DISCORD_MESSAGE_LIMIT:
+            # Too many dice to list individually; just report the total.
+            result = f"🎲 You rolled {len(rolls)} dice for a total of {total}"
+        await ctx.send(result)
+    except ValueError as e:
+        await ctx.send(f"⚠️ {e}")
+
+
+@bot.command(name="createchar")
+async def handle_createchar(ctx: commands.Context, *, name: str = "") -> None:
+    """Character creation: !createchar Name"""
+    if not name:
+        await ctx.send("Please provide a name for your character.")
+        return
+    if len(name) > MAX_NAME_LENGTH:
+        await ctx.send(f"Character names can be at most {MAX_NAME_LENGTH} characters.")
         return
+    user_id = str(ctx.author.id)
+    if user_id not in characters:
+        character_order.append(user_id)
+    characters[user_id] = {
+        "name": name,
+        "class": "",
+        "items": [],
+    }
+    with transaction():
+        # Upsert keeps the row (and so the character's place in the order).
+        db.execute(
+            "INSERT INTO characters (user_id, name, class) VALUES (?, ?, '') "
+            "ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, class = ''",
+            (user_id, name),
+        )
+        db.execute("DELETE FROM items WHERE user_id = ?", (user_id,))
+    await ctx.send(f"Character '{name}' created!")
 
-    # Add item: !additem Item Name
-    if content.startswith("!additem"):
-        item_name = content[len("!additem"):].strip()
-        user_id = str(message.author.id)
-        char = characters.get(user_id)
-        if not char:
-            await message.channel.send("Create a character first using !createchar.")
-            return
-        if not item_name:
-            await message.channel.send("Please specify an item to add.")
-            return
-        char.setdefault("items", []).append(item_name)
-        save_characters()
-        await message.channel.send(f"Added {item_name} to {char['name']}'s inventory.")
+
+@bot.command(name="sheet")
+async def handle_sheet(ctx: commands.Context) -> None:
+    """Character sheet: !sheet"""
+    user_id = str(ctx.author.id)
+    char = characters.get(user_id)
+    if not char:
+        await ctx.send("You don't have a character yet. Use !createchar <name> to create one.")
+        return
+    name = char.get("name", "Unnamed")
+    char_class = char.get("class", "Unassigned") or "Unassigned"
+    items = char.get("items", [])
+    item_list = ", ".join(items) if items else "No items"
+    async with ReplyBuffer(ctx) as reply:
+        reply.add(f"📜 **{name}** (Class: {char_class})")
+        inventory = f"Inventory: {item_list}"
+        if len(inventory) <= DISCORD_MESSAGE_LIMIT:
+            reply.add(inventory)
+        else:
+            # A large inventory spans several messages; one item per line
+            # keeps every message break between items.
+            reply.add("Inventory:")
+            for item in items:
+                reply.add(f"• {item}")
+
+
+@bot.command(name="setclass")
+async def handle_setclass(ctx: commands.Context, *, class_name: str = "") -> None:
+    """Set class: !setclass Class Name"""
+    user_id = str(ctx.author.id)
+    char = characters.get(user_id)
+    if not char:
+        await ctx.send("Create a character first using !createchar.")
+        return
+    if not class_name:
+        await ctx.send("Please specify a class.")
         return
+    if len(class_name) > MAX_CLASS_LENGTH:
+        await ctx.send(f"Class names can be at most {MAX_CLASS_LENGTH} characters.")
+        return
+    char["class"] = class_name = sys.intern(class_name)
+    db.execute("UPDATE characters SET class = ? WHERE user_id = ?", (class_name, user_id))
+    await ctx.send(f"Class set to {class_name} for {char['name']}.")
+
+
+@bot.command(name="additem")
+async def handle_additem(ctx: commands.Context, *, item_name: str = "") -> None:
+    """Add item: !additem Item Name"""
+    user_id = str(ctx.author.id)
+    char = characters.get(user_id)
+    if not char:
+        await ctx.send("Create a character first using !createchar.")
+        return
+    if not item_name:
+        await ctx.send("Please specify an item to add.")
+        return
+    if len(item_name) > MAX_ITEM_LENGTH:
+        await ctx.send(f"Item names can be at most {MAX_ITEM_LENGTH} characters.")
+        return
+    if len(char.get("items", [])) >= MAX_ITEMS:
+        await ctx.send(f"{char['name']}'s inventory is full ({MAX_ITEMS} items).")
+        return
+    item_name = sys.intern(item_name)
+    char.setdefault("items", []).append(item_name)
+    db.execute("INSERT INTO items (user_id, item) VALUES (?, ?)", (user_id, item_name))
+    await ctx.send(f"Added {item_name} to {char['name']}'s inventory.")
 
-    # Combat commands
-    # Start combat: !startcombat
-    if content.startswith("!startcombat"):
-        if combat_state.get("ongoing"):
-            await message.channel.send("Combat is already in progress.")
-            return
-        # Build a turn order from all existing characters
-        turn_order = [c["name"] for c in characters.values()]
-        if not turn_order:
-            await message.channel.send("No characters exist to start combat.")
-            return
-        random.shuffle(turn_order)
-        combat_state["ongoing"] = True
-        combat_state["turn_order"] = turn_order
-        combat_state["current_index"] = 0
-        save_combat()
-        await message.channel.send(
-            "⚔️ Combat begins! Turn order: " + ", ".join(turn_order) + f"\nIt is now {turn_order[0]}'s turn."
-        )
+
+@bot.command(name="startcombat")
+async def handle_startcombat(ctx: commands.Context) -> None:
+    """Start combat: !startcombat"""
+    if combat_state.get("ongoing"):
+        await ctx.send("Combat is already in progress.")
+        return
+    # Turn order holds user ids; names are looked up only for display.
+    turn_order = list(character_order)
+    if not turn_order:
+        await ctx.send("No characters exist to start combat.")
+        return
+    random.shuffle(turn_order)
+    combat_state["ongoing"] = True
+    combat_state["turn_order"] = deque(turn_order)
+    save_combat()
+    names = [character_name(uid) for uid in turn_order]
+    async with ReplyBuffer(ctx) as reply:
+        reply.add("⚔️ Combat begins! Turn order: " + ", ".join(names))
+        reply.add(f"It is now {names[0]}'s turn.")
+
+
+@bot.command(name="endturn")
+async def handle_endturn(ctx: commands.Context) -> None:
+    """End turn: !endturn"""
+    if not combat_state.get("ongoing"):
+        await ctx.send("No combat is currently in progress.")
         return
+    turn_order = combat_state["turn_order"]
+    turn_order.rotate(-1)
+    save_combat_key("turn_order")
+    await ctx.send(f"It is now {character_name(turn_order[0])}'s turn.")
 
-    # End turn: !endturn
-    if content.startswith("!endturn"):
-        if not combat_state.get("ongoing"):
-            await message.channel.send("No combat is currently in progress.")
-            return
-        turn_order = combat_state.get("turn_order", [])
-        idx = combat_state.get("current_index", 0)
-        idx = (idx + 1) % len(turn_order) if turn_order else 0
-        combat_state["current_index"] = idx
-        save_combat()
-        await message.channel.send(f"It is now {turn_order[idx]}'s turn.")
+
+@bot.command(name="endcombat")
+async def handle_endcombat(ctx: commands.Context) -> None:
+    """End combat: !endcombat"""
+    if not combat_state.get("ongoing"):
+        await ctx.send("No combat is currently in progress.")
         return
+    combat_state.clear()
+    save_combat()
+    await ctx.send("🛑 Combat has ended.")
 
-    # End combat: !endcombat
-    if content.startswith("!endcombat"):
-        if not combat_state.get("ongoing"):
-            await message.channel.send("No combat is currently in progress.")
-            return
-        combat_state.clear()
-        save_combat()
-        await message.channel.send("🛑 Combat has ended.")
+
+@bot.event
+async def on_command_error(ctx: commands.Context, error: commands.CommandError) -> None:
+    # Ordinary chat that happens to start with "!" isn't an error.
+    if isinstance(error, commands.CommandNotFound):
         return
+    print(f"Error in command {ctx.command}:")
+    traceback.print_exception(type(error), error, error.__traceback__)
 
 
-# Entrypoint for running the bot.  We only call client.run if DISCORD_TOKEN
+# Entrypoint for running the bot.  We only call bot.run if DISCORD_TOKEN
 # is set.  When running locally, ensure you have a .env file or environment
 # variables defined.
 if __name__ == "__main__":
@@ -282,4 +892,10 @@ if __name__ == "__main__":
         raise RuntimeError(
             "Missing DISCORD_TOKEN or OPENAI_API_KEY environment variables."
         )
-    client.run(DISCORD_TOKEN)
\ No newline at end of file
+    aclient = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # Load persisted state once at startup rather than in on_ready, which also
+    # fires on reconnects.
+    open_db()
+    load_data()
+    load_prompt_cache()
+    bot.run(DISCORD_TOKEN)
\ No newline at end of file